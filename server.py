@@ -11,7 +11,7 @@ from markdown import markdown
 from dotenv import load_dotenv
 from uuid import uuid4
 from werkzeug.middleware.proxy_fix import ProxyFix
-from server_classes import WaitingPrompt,ProcessingGeneration,KAIServer,PromptsIndex,GenerationsIndex,User,Database
+from server_classes import WaitingPrompt,ProcessingGeneration,KAIServer,PromptsIndex,GenerationsIndex,User,Database,round_kudos_details
 from logger import logger, set_logger_verbosity, quiesce_logger
 
 class ServerErrors(Enum):
@@ -105,8 +105,8 @@ class SyncGenerate(Resource):
 
         )
         server_found = False
-        for server in _db.servers.values():
-            if len(args.servers) and server.id not in args.servers:
+        for server in _db.get_all_servers():
+            if wp.servers and server.id not in wp.servers:
                 continue
             if server.can_generate(wp)[0]:
                 server_found = True
@@ -288,7 +288,7 @@ class Servers(Resource):
     @logger.catch
     def get(self, api_version = None):
         servers_ret = []
-        for server in _db.servers.values():
+        for server in _db.get_all_servers():
             if server.is_stale():
                 continue
             sdict = {
@@ -299,8 +299,8 @@ class Servers(Resource):
                 "max_content_length": server.max_content_length,
                 "chars_generated": server.contributions,
                 "requests_fulfilled": server.fulfilments,
-                "kudos_rewards": server.kudos,
-                "kudos_details": server.kudos_details,
+                "kudos_rewards": round(server.kudos, 2),
+                "kudos_details": round_kudos_details(server.kudos_details),
                 "performance": server.get_performance(),
                 "uptime": server.uptime,
             }
@@ -311,7 +311,7 @@ class ServerSingle(Resource):
     @logger.catch
     def get(self, api_version = None, server_id = ''):
         server = None
-        for s in _db.servers.values():
+        for s in _db.get_all_servers():
             if s.id == server_id:
                 server = s
                 break
@@ -336,11 +336,11 @@ class Users(Resource):
     @logger.catch
     def get(self, api_version = None):
         user_dict = {}
-        for user in _db.users.values():
+        for user in _db.get_all_users():
             user_dict[user.get_unique_alias()] = {
                 "id": user.id,
-                "kudos": user.kudos,
-                "kudos_details": user.kudos_details,
+                "kudos": round(user.kudos, 2),
+                "kudos_details": round_kudos_details(user.kudos_details),
                 "usage": user.usage,
                 "contributions": user.contributions,
             }
@@ -352,14 +352,14 @@ class UserSingle(Resource):
     def get(self, api_version = None, user_id = ''):
         logger.debug(user_id)
         user = None
-        for u in _db.users.values():
+        for u in _db.get_all_users():
             if str(u.id) == user_id:
                 user = u
                 break
         if user:
             udict = {
                 "username": user.get_unique_alias(),
-                "kudos": user.kudos,
+                "kudos": round(user.kudos, 2),
                 "usage": user.usage,
                 "contributions": user.contributions,
             }
@@ -471,8 +471,7 @@ def register():
         api_key = secrets.token_urlsafe(16)
         if user:
             username = request.form['username']
-            user.username = request.form['username']
-            user.api_key = api_key
+            user.modify_registration(request.form['username'], api_key)
         else:
             # Triggered when the user created a username without logging in
             if not oauth_id:
@@ -523,7 +522,7 @@ def transfer():
             kudos = ret[0]
             error = ret[1]
     if src_user:
-        welcome = f"Welcome back {src_user.get_unique_alias()}. You have {src_user.kudos} kudos remaining"
+        welcome = f"Welcome back {src_user.get_unique_alias()}. You have {round(src_user.kudos, 2)} kudos remaining"
     return render_template('transfer_kudos.html',
                            page_title="Kudos Transfer",
                            welcome=welcome,
@@ -586,9 +585,9 @@ if __name__ == "__main__":
     quiesce_logger(args.quiet)    
     # Only setting this for the WSGI logs
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s',level=logging.ERROR)
-    _db = Database()
     _waiting_prompts = PromptsIndex()
     _processing_generations = GenerationsIndex()
+    _db = Database(_waiting_prompts)
     google_client_id = os.getenv("GOOGLE_CLIENT_ID")
     google_client_secret = os.getenv("GLOOGLE_CLIENT_SECRET")
     discord_client_id = os.getenv("DISCORD_CLIENT_ID")
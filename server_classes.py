@@ -1,9 +1,20 @@
-import json, os
+import os, orjson
 from uuid import uuid4
-from datetime import datetime
-import threading, time
+from datetime import datetime, timedelta
+import threading, time, collections, concurrent.futures
 from logger import logger
 
+def serialize_date(obj):
+    # Our serialize() methods leave dates as datetime objects, which we format only when writing them to disk
+    if isinstance(obj, datetime):
+        # This is the same "YYYY-MM-DD HH:MM:SS" format we've always stored, which fromisoformat() can parse
+        return(obj.isoformat(sep=' ', timespec='seconds'))
+    raise TypeError
+
+def round_kudos_details(kudos_details):
+    # We keep kudos at full precision internally and only round them when we display or store them
+    return({action: round(kudos, 2) for action, kudos in kudos_details.items()})
+
 class WaitingPrompt:
     # Every 10 secs we store usage data to disk
     def __init__(self, db, wps, pgs, prompt, user, models, params, **kwargs):
@@ -12,7 +23,8 @@ class WaitingPrompt:
         self._processing_generations = pgs
         self.prompt = prompt
         self.user = user
-        self.models = models
+        # We only ever check membership against the acceptable models and servers, so we store them as sets
+        self.models = set(models)
         self.params = params
         self.n = params.get('n', 1)
         # We assume more than 20 is not needed. But I'll re-evalute if anyone asks.
@@ -30,8 +42,8 @@ class WaitingPrompt:
         self.gen_payload["n"] = 1
         # The generations that have been created already
         self.processing_gens = []
-        self.last_process_time = datetime.now()
-        self.servers = kwargs.get("servers", [])
+        self.last_process_time = self._db._now_tick
+        self.servers = set(kwargs.get("servers", []))
         self.softprompts = kwargs.get("softprompts", [''])
         # Prompt requests are removed after 10 mins of inactivity, to prevent memory usage
         self.stale_time = 600
@@ -42,9 +54,6 @@ class WaitingPrompt:
         # Before we add it to the queue
         self._waiting_prompts.add_item(self)
         logger.info(f"New prompt request by user: {self.user.get_unique_alias()}")
-        thread = threading.Thread(target=self.check_for_stale, args=())
-        thread.daemon = True
-        thread.start()
 
     def needs_gen(self):
         if self.n > 0:
@@ -52,11 +61,11 @@ class WaitingPrompt:
         return(False)
 
     def start_generation(self, server, matching_softprompt):
-        if self.n <= 0:
+        # This also refuses prompts which have run out of generations, or were deleted since the server fetched them
+        if not self._waiting_prompts._dec_n(self):
             return
         new_gen = ProcessingGeneration(self, self._processing_generations, server)
         self.processing_gens.append(new_gen)
-        self.n -= 1
         self.refresh()
         prompt_payload = {
             "payload": self.gen_payload,
@@ -104,25 +113,21 @@ class WaitingPrompt:
         self.total_usage += chars
         self.user.record_usage(chars, kudos)
         self.refresh()
-
-    def check_for_stale(self):
-        while True:
-            if self.is_stale():
-                self.delete()
-                break
-            time.sleep(10)
+        if self.is_completed():
+            self._waiting_prompts._mark_completed(self)
 
     def delete(self):
         for gen in self.processing_gens:
             gen.delete()
         self._waiting_prompts.del_item(self)
-        del self
+        # The generations point back to us, so we break the cycle to let both be freed straight away
+        self.processing_gens = []
 
     def refresh(self):
-        self.last_process_time = datetime.now()
+        self.last_process_time = self._db._now_tick
 
     def is_stale(self):
-        if (datetime.now() - self.last_process_time).seconds > self.stale_time:
+        if self._db._now_tick - self.last_process_time > self.stale_time:
             return(True)
         return(False)
 
@@ -135,8 +140,9 @@ class ProcessingGeneration:
         self.server = server
         # We store the model explicitly, in case the server changed models between generations
         self.model = server.model
+        self.kudos_factor = server._kudos_factor
         self.generation = None
-        self.start_time = datetime.now()
+        self.start_time = time.monotonic()
         self._processing_generations.add_item(self)
 
     def set_generation(self, generation):
@@ -144,8 +150,8 @@ class ProcessingGeneration:
             return(0)
         self.generation = generation
         chars = len(generation)
-        kudos = self.owner._db.convert_chars_to_kudos(chars, self.model)
-        self.server.record_contribution(chars, kudos, (datetime.now() - self.start_time).seconds)
+        kudos = round(chars * self.kudos_factor, 2)
+        self.server.record_contribution(chars, kudos, time.monotonic() - self.start_time)
         self.owner.record_usage(chars, kudos)
         logger.info(f"New Generation worth {kudos} kudos, delivered by server: {self.server.name}")
         return(chars)
@@ -157,7 +163,6 @@ class ProcessingGeneration:
 
     def delete(self):
         self._processing_generations.del_item(self)
-        del self
 
 
 class KAIServer:
@@ -170,22 +175,25 @@ class KAIServer:
         self.last_reward_uptime = 0
         # Every how many seconds does this server get a kudos reward
         self.uptime_reward_threshold = 600
+        # The kudos per char generated for the current model
+        self._kudos_factor = None
 
     def create(self, user, name, softprompts):
         self.user = user
         self.name = name
-        self.softprompts = softprompts
+        self.set_softprompts(softprompts)
         self.id = str(uuid4())
         self.contributions = 0
         self.fulfilments = 0
         self.kudos = 0
-        self.performances = []
+        self.performances = collections.deque(maxlen=20)
+        self._perf_sum = 0.0
         self.uptime = 0
         self._db.register_new_server(self)
 
     def check_in(self, model, max_length, max_content_length, softprompts):
         if not self.is_stale():
-            self.uptime += (datetime.now() - self.last_check_in).seconds
+            self.uptime += int(self._db._now_tick - self.last_check_in)
             # Every 10 minutes of uptime gets kudos rewarded
             if self.uptime - self.last_reward_uptime > self.uptime_reward_threshold:
                 # Bigger model uptime gets more kudos
@@ -198,11 +206,21 @@ class KAIServer:
             # If the server comes back from being stale, we just reset their last_reward_uptime
             # So that they have to stay up at least 10 mins to get uptime kudos
             self.last_reward_uptime = self.uptime
-        self.last_check_in = datetime.now()
+        self.last_check_in = self._db._now_tick
+        # We only need to look up the kudos factor when the model changes, or while its multiplier is still being calculated
+        if self._kudos_factor is None or model != self.model or model not in self._db._kudos_factor:
+            self._kudos_factor = self._db.get_kudos_factor(model)
         self.model = model
         self.max_content_length = max_content_length
         self.max_length = max_length
+        self.set_softprompts(softprompts)
+        self._db._dirty_servers = True
+
+    def set_softprompts(self, softprompts):
         self.softprompts = softprompts
+        # We join all softprompt names with a separator they can't contain
+        # So that we can check if a requested softprompt is a substring of any of them, with a single lookup
+        self._softprompts_blob = '\x00'.join(softprompts)
 
     def get_human_readable_uptime(self):
         if self.uptime < 60:
@@ -216,66 +234,62 @@ class KAIServer:
 
     def can_generate(self, waiting_prompt):
         # takes as an argument a WaitingPrompt class and checks if this server is valid for generating it
-        is_matching = True
-        skipped_reason = None
-        if len(waiting_prompt.servers) >= 1 and self.id not in waiting_prompt.servers:
-            is_matching = False
-            skipped_reason = 'server_id'
-        if len(waiting_prompt.models) >= 1 and self.model not in waiting_prompt.models:
-            is_matching = False
-            skipped_reason = 'models'
+        # We check the cheapest filters first and return on the first one that doesn't match
         if self.max_content_length < waiting_prompt.max_content_length:
-            is_matching = False
-            skipped_reason = 'max_content_length'
+            return([False,'max_content_length'])
         if self.max_length < waiting_prompt.max_length:
-            is_matching = False
-            skipped_reason = 'max_length'
-        matching_softprompt = False
+            return([False,'max_length'])
+        if waiting_prompt.models and self.model not in waiting_prompt.models:
+            return([False,'models'])
+        if waiting_prompt.servers and self.id not in waiting_prompt.servers:
+            return([False,'server_id'])
         for sp in waiting_prompt.softprompts:
             # If a None softprompts has been provided, we always match, since we can always remove the softprompt
-            if sp == '':
-                matching_softprompt = True
-                break
-            for sp_name in self.softprompts:
-                if sp in sp_name:
-                    matching_softprompt = True
-                    break
-        if not matching_softprompt:
-            is_matching = False
-            skipped_reason = 'matching_softprompt'
-        return([is_matching,skipped_reason])
+            if sp == '' or sp in self._softprompts_blob:
+                return([True,None])
+        return([False,'matching_softprompt'])
 
     def record_contribution(self, chars, kudos, seconds_taken):
-        perf = round(chars / seconds_taken,1)
+        perf = chars / seconds_taken
         self.user.record_contributions(chars, kudos)
         self.modify_kudos(kudos,'generated')
         self._db.record_fulfilment(perf)
         self.contributions += chars
         self.fulfilments += 1
+        self._db.record_total_usage(chars)
+        self._db.check_top_server(self)
+        # We keep a running sum, so that the average performance doesn't need to be recalculated every time
+        if len(self.performances) == self.performances.maxlen:
+            self._perf_sum -= self.performances[0]
         self.performances.append(perf)
-        if len(self.performances) > 20:
-            del self.performances[0]
+        self._perf_sum += perf
+        self._db._dirty_servers = True
 
     def modify_kudos(self, kudos, action = 'generated'):
-        self.kudos = round(self.kudos + kudos, 2)
-        self.kudos_details[action] = round(self.kudos_details.get(action,0) + abs(kudos), 2) 
+        self.kudos += kudos
+        self.kudos_details[action] = self.kudos_details.get(action,0) + abs(kudos)
+        self._db._dirty_servers = True
 
     def get_performance(self):
         if len(self.performances):
-            ret_str = f'{round(sum(self.performances) / len(self.performances),1)} chars per second'
+            ret_str = f'{round(self._perf_sum / len(self.performances),1)} chars per second'
         else:
             ret_str = f'No requests fulfilled yet'
         return(ret_str)
 
     def is_stale(self):
         try:
-            if (datetime.now() - self.last_check_in).seconds > 300:
+            if self._db._now_tick - self.last_check_in > 300:
                 return(True)
         # If the last_check_in isn't set, it's a new server, so it's stale by default
         except AttributeError:
             return(True)
         return(False)
 
+    # last_check_in is a monotonic tick, so we only convert it to a date for storage
+    def get_last_check_in_date(self):
+        return(datetime.now() - timedelta(seconds=self._db._now_tick - self.last_check_in))
+
     def serialize(self):
         ret_dict = {
             "oauth_id": self.user.oauth_id,
@@ -285,10 +299,10 @@ class KAIServer:
             "max_content_length": self.max_content_length,
             "contributions": self.contributions,
             "fulfilments": self.fulfilments,
-            "kudos": self.kudos,
-            "kudos_details": self.kudos_details,
-            "performances": self.performances,
-            "last_check_in": self.last_check_in.strftime("%Y-%m-%d %H:%M:%S"),
+            "kudos": round(self.kudos, 2),
+            "kudos_details": round_kudos_details(self.kudos_details),
+            "performances": list(self.performances),
+            "last_check_in": self.get_last_check_in_date(),
             "id": self.id,
             "softprompts": self.softprompts,
             "uptime": self.uptime,
@@ -305,52 +319,101 @@ class KAIServer:
         self.fulfilments = saved_dict["fulfilments"]
         self.kudos = saved_dict.get("kudos",0)
         self.kudos_details = saved_dict.get("kudos_details",self.kudos_details)
-        self.performances = saved_dict.get("performances",[])
-        self.last_check_in = datetime.strptime(saved_dict["last_check_in"],"%Y-%m-%d %H:%M:%S")
+        self.performances = collections.deque(saved_dict.get("performances",[]), maxlen=20)
+        self._perf_sum = sum(self.performances)
+        last_check_in_date = datetime.fromisoformat(saved_dict["last_check_in"])
+        self.last_check_in = self._db._now_tick - (datetime.now() - last_check_in_date).total_seconds()
         self.id = saved_dict["id"]
-        self.softprompts = saved_dict.get("softprompts",[])
+        self.set_softprompts(saved_dict.get("softprompts",[]))
         self.uptime = saved_dict.get("uptime",0)
         self._db.servers[self.name] = self
 
 class Index:
     def __init__(self):
         self._index = {}
+        # Items are added and removed by request threads while others iterate them
+        self._lock = threading.RLock()
 
     def add_item(self, item):
-        self._index[item.id] = item
+        with self._lock:
+            self._index[item.id] = item
 
     def get_item(self, uuid):
         return(self._index.get(uuid))
 
     def del_item(self, item):
-        del self._index[item.id]
+        with self._lock:
+            del self._index[item.id]
 
     def get_all(self):
-        return(self._index.values())
+        # We return a snapshot, so that the caller can iterate it while the index changes
+        with self._lock:
+            return(list(self._index.values()))
 
 
 class PromptsIndex(Index):
+    # We maintain these aggregates as prompts change, as they are polled far more often than prompts are added
+    def __init__(self):
+        super().__init__()
+        self._per_user_waiting = collections.Counter()
+        # The ids of the prompts currently counted in _per_user_waiting
+        # So that a prompt is only ever discounted once, even if it completes and gets deleted concurrently
+        self._counted_waiting = set()
+        self._total_n = 0
+        # The prompts which still have generations left to start
+        # We use a dict as an ordered set, so that prompts with equal kudos keep their queue order
+        self._needs_gen = {}
+
+    def add_item(self, item):
+        with self._lock:
+            super().add_item(item)
+            if not item.is_completed():
+                self._per_user_waiting[item.user] += 1
+                self._counted_waiting.add(item.id)
+            self._total_n += item.n
+            if item.needs_gen():
+                self._needs_gen[item] = None
+
+    def del_item(self, item):
+        with self._lock:
+            super().del_item(item)
+            self._decrement_user_waiting(item)
+            self._total_n -= item.n
+            self._needs_gen.pop(item, None)
+
+    def _dec_n(self, item):
+        # We decrement n under the lock, so that concurrent pops or a concurrent delete can't skew the totals
+        with self._lock:
+            if item.id not in self._index or item.n <= 0:
+                return(False)
+            item.n -= 1
+            self._total_n -= 1
+            if not item.needs_gen():
+                self._needs_gen.pop(item, None)
+            return(True)
+
+    def _mark_completed(self, item):
+        with self._lock:
+            self._decrement_user_waiting(item)
+
+    def _decrement_user_waiting(self, item):
+        if item.id not in self._counted_waiting:
+            return
+        self._counted_waiting.discard(item.id)
+        self._per_user_waiting[item.user] -= 1
+        if self._per_user_waiting[item.user] <= 0:
+            del self._per_user_waiting[item.user]
 
     def count_waiting_requests(self, user):
-        count = 0
-        for wp in self._index.values():
-            if wp.user == user and not wp.is_completed():
-                count += 1
-        return(count)
+        return(self._per_user_waiting[user])
 
     def count_total_waiting_generations(self):
-        count = 0
-        for wp in self._index.values():
-            count += wp.n
-        return(count)
+        return(self._total_n)
 
     def get_waiting_wp_by_kudos(self):
-        sorted_wp_list = sorted(self._index.values(), key=lambda x: x.user.kudos, reverse=True)
-        final_wp_list = []
-        for wp in sorted_wp_list:
-            if wp.needs_gen():
-                final_wp_list.append(wp)
-        return(final_wp_list)
+        with self._lock:
+            waiting_wp_list = list(self._needs_gen)
+        return(sorted(waiting_wp_list, key=lambda x: x.user.kudos, reverse=True))
 
 
 
@@ -383,6 +446,7 @@ class User:
             "chars": 0,
             "requests": 0
         }
+        self._db._index_user(self)
 
     def create(self, username, oauth_id, api_key, invite_id):
         self.username = username
@@ -392,6 +456,7 @@ class User:
         self.creation_date = datetime.now()
         self.last_active = datetime.now()
         self.id = self._db.register_new_user(self)
+        self._db._index_user(self)
         self.contributions = {
             "chars": 0,
             "fulfillments": 0
@@ -401,6 +466,14 @@ class User:
             "requests": 0
         }
 
+    # Used when a user re-registers, to ensure the lookup indexes stay consistent
+    def modify_registration(self, username, api_key):
+        self._db._unindex_user(self)
+        self.username = username
+        self.api_key = api_key
+        self._db._index_user(self)
+        self._db._dirty_users = True
+
     # Checks that this user matches the specified API key
     def check_key(api_key):
         if self.api_key and self.api_key == api_key:
@@ -414,18 +487,22 @@ class User:
         self.usage["chars"] += chars
         self.usage["requests"] += 1
         self.modify_kudos(-kudos,"accumulated")
+        self._db._dirty_users = True
 
     def record_contributions(self, chars, kudos):
         self.contributions["chars"] += chars
         self.contributions["fulfillments"] += 1
         self.modify_kudos(kudos,"accumulated")
+        self._db.check_top_contributor(self)
+        self._db._dirty_users = True
 
     def record_uptime(self, kudos):
         self.modify_kudos(kudos,"accumulated")
 
     def modify_kudos(self, kudos, action = 'accumulated'):
-        self.kudos = round(self.kudos + kudos, 2)
-        self.kudos_details[action] = round(self.kudos_details.get(action,0) + kudos, 2)
+        self.kudos += kudos
+        self.kudos_details[action] = self.kudos_details.get(action,0) + kudos
+        self._db._dirty_users = True
 
 
     def serialize(self):
@@ -433,14 +510,14 @@ class User:
             "username": self.username,
             "oauth_id": self.oauth_id,
             "api_key": self.api_key,
-            "kudos": self.kudos,
-            "kudos_details": self.kudos_details,
+            "kudos": round(self.kudos, 2),
+            "kudos_details": round_kudos_details(self.kudos_details),
             "id": self.id,
             "invite_id": self.invite_id,
             "contributions": self.contributions,
             "usage": self.usage,
-            "creation_date": self.creation_date.strftime("%Y-%m-%d %H:%M:%S"),
-            "last_active": self.last_active.strftime("%Y-%m-%d %H:%M:%S"),
+            "creation_date": self.creation_date,
+            "last_active": self.last_active,
         }
         return(ret_dict)
 
@@ -462,31 +539,55 @@ class User:
         #     self.usage["chars"] = self.usage["tokens"] * 4
         #     self.record_contributions(self.usage["chars"], -self.usage["chars"] / 100)
         #     del self.usage["tokens"]
-        self.creation_date = datetime.strptime(saved_dict["creation_date"],"%Y-%m-%d %H:%M:%S")
-        self.last_active = datetime.strptime(saved_dict["last_active"],"%Y-%m-%d %H:%M:%S")
+        self.creation_date = datetime.fromisoformat(saved_dict["creation_date"])
+        self.last_active = datetime.fromisoformat(saved_dict["last_active"])
+        self._db._index_user(self)
 
 
 class Database:
-    def __init__(self, interval = 3):
+    def __init__(self, waiting_prompts, interval = 3):
         self.interval = interval
+        self._waiting_prompts = waiting_prompts
+        # Guards the users and servers dicts, which request threads modify while the writer thread iterates them
+        self._lock = threading.RLock()
+        # A coarse monotonic clock, refreshed every second, used for the hot staleness checks
+        self._now_tick = time.monotonic()
         self.ALLOW_ANONYMOUS = True
         # This is used for synchronous generations
         self.SERVERS_FILE = "db/servers.json"
         self.servers = {}
+        # We don't store data for anon servers, so we keep the rest separately, to avoid filtering them on every write
+        # We use a dict as an ordered set, so that servers keep their registration order on disk
+        self._persistent_servers = {}
         # Other miscellaneous statistics
         self.STATS_FILE = "db/stats.json"
         self.stats = {
             "fulfilment_times": [],
             "model_mulitpliers": {},
         }
+        # The model multipliers precomputed as kudos per char
+        self._kudos_factor = {}
+        # Model multipliers can take several seconds to calculate, so we do it in the background
+        self._multiplier_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_multipliers = set()
+        # When we can't calculate a multiplier, we don't store the fallback, but we wait before trying again
+        self._multiplier_failures = {}
+        self.multiplier_retry_interval = 3600
+        # Set whenever the matching data changes, so that we only rewrite the files which need it
+        self._dirty_users = False
+        self._dirty_servers = False
+        self._dirty_stats = False
         self.USERS_FILE = "db/users.json"
         self.users = {}
+        # Reverse indexes to avoid scanning all users on every authenticated request
+        self._users_by_api_key = {}
+        self._users_by_username_id = {}
         # Increments any time a new user is added
         # Is appended to usernames, to ensure usernames never conflict
         self.last_user_id = 0
         if os.path.isfile(self.USERS_FILE):
-            with open(self.USERS_FILE) as db:
-                serialized_users = json.load(db)
+            with open(self.USERS_FILE, 'rb') as db:
+                serialized_users = orjson.loads(db.read())
                 for user_dict in serialized_users:
                     new_user = User(self)
                     new_user.deserialize(user_dict)
@@ -499,19 +600,57 @@ class Database:
             self.anon.create_anon()
             self.users[self.anon.oauth_id] = self.anon
         if os.path.isfile(self.SERVERS_FILE):
-            with open(self.SERVERS_FILE) as db:
-                serialized_servers = json.load(db)
+            with open(self.SERVERS_FILE, 'rb') as db:
+                serialized_servers = orjson.loads(db.read())
                 for server_dict in serialized_servers:
                     new_server = KAIServer(self)
                     new_server.deserialize(server_dict)
                     self.servers[new_server.name] = new_server
+                    if new_server.user != self.anon:
+                        self._persistent_servers[new_server] = None
         if os.path.isfile(self.STATS_FILE):
-            with open(self.STATS_FILE) as db:
-                self.stats = json.load(db)
-
+            with open(self.STATS_FILE, 'rb') as db:
+                self.stats = orjson.loads(db.read())
+        self.stats["fulfilment_times"] = collections.deque(self.stats.get("fulfilment_times",[]), maxlen=10)
+        self._fulfilment_sum = sum(self.stats["fulfilment_times"])
+        for model_name, multiplier in self.stats["model_mulitpliers"].items():
+            self._kudos_factor[model_name] = multiplier / 100
+        # These are polled on every stats request, so we calculate them once here and then keep them updated
+        self._totals = {
+            "chars": 0,
+            "fulfilments": 0,
+        }
+        self._top_server = None
+        for server in self.get_all_servers():
+            self._totals["chars"] += server.contributions
+            self._totals["fulfilments"] += server.fulfilments
+            self.check_top_server(server)
+        self._top_contributor = None
+        for user in self.get_all_users():
+            self.check_top_contributor(user)
+
+        thread = threading.Thread(target=self.update_tick, args=())
+        thread.daemon = True
+        thread.start()
         thread = threading.Thread(target=self.write_files, args=())
         thread.daemon = True
         thread.start()
+        # A single thread reaps stale prompts, instead of one thread per prompt
+        thread = threading.Thread(target=self.check_for_stale_prompts, args=())
+        thread.daemon = True
+        thread.start()
+
+    def update_tick(self):
+        while True:
+            self._now_tick = time.monotonic()
+            time.sleep(1)
+
+    def check_for_stale_prompts(self):
+        while True:
+            for wp in self._waiting_prompts.get_all():
+                if wp.is_stale():
+                    wp.delete()
+            time.sleep(10)
 
     def write_files(self):
         while True:
@@ -521,43 +660,68 @@ class Database:
     def write_files_to_disk(self):
         if not os.path.exists('db'):
             os.mkdir('db')
-        server_serialized_list = []
-        for server in self.servers.values():
-            # We don't store data for anon servers
-            if server.user == self.anon: continue
-            server_serialized_list.append(server.serialize())
-        with open(self.SERVERS_FILE, 'w') as db:
-            json.dump(server_serialized_list,db)
-        with open(self.STATS_FILE, 'w') as db:
-            json.dump(self.stats,db)
-        user_serialized_list = []
-        for user in self.users.values():
-            user_serialized_list.append(user.serialize())
-        with open(self.USERS_FILE, 'w') as db:
-            json.dump(user_serialized_list,db)
+        # We clear each flag before serializing, so that changes made while we write are picked up next time
+        # We only hold the lock while taking a snapshot, not while serializing it
+        if self._dirty_servers:
+            self._dirty_servers = False
+            with self._lock:
+                persistent_servers = list(self._persistent_servers)
+            server_serialized_list = [server.serialize() for server in persistent_servers]
+            self.write_json_file(self.SERVERS_FILE, server_serialized_list)
+        if self._dirty_stats:
+            self._dirty_stats = False
+            with self._lock:
+                serialized_stats = dict(self.stats)
+                serialized_stats["fulfilment_times"] = list(self.stats["fulfilment_times"])
+                serialized_stats["model_mulitpliers"] = dict(self.stats["model_mulitpliers"])
+            self.write_json_file(self.STATS_FILE, serialized_stats)
+        if self._dirty_users:
+            self._dirty_users = False
+            user_serialized_list = []
+            for user in self.get_all_users():
+                user_serialized_list.append(user.serialize())
+            self.write_json_file(self.USERS_FILE, user_serialized_list)
+
+    def write_json_file(self, filename, obj):
+        # We write to a temp file and then swap it in, so that a crash mid-write doesn't truncate the db
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as db:
+            db.write(orjson.dumps(obj, default=serialize_date, option=orjson.OPT_PASSTHROUGH_DATETIME))
+        os.replace(tmp_filename, filename)
+
+    def check_top_contributor(self, user):
+        with self._lock:
+            top_contribution = 0
+            if self._top_contributor:
+                top_contribution = self._top_contributor.contributions['chars']
+            if user.contributions['chars'] > top_contribution and user != self.anon:
+                self._top_contributor = user
+
+    def check_top_server(self, server):
+        with self._lock:
+            top_server_contribution = 0
+            if self._top_server:
+                top_server_contribution = self._top_server.contributions
+            if server.contributions > top_server_contribution:
+                self._top_server = server
 
     def get_top_contributor(self):
-        top_contribution = 0
-        top_contributor = None
-        user = None
-        for user in self.users.values():
-            if user.contributions['chars'] > top_contribution and user != self.anon:
-                top_contributor = user
-                top_contribution = user.contributions['chars']
-        return(top_contributor)
+        return(self._top_contributor)
 
     def get_top_server(self):
-        top_server = None
-        top_server_contribution = 0
-        for server in self.servers:
-            if self.servers[server].contributions > top_server_contribution:
-                top_server = self.servers[server]
-                top_server_contribution = self.servers[server].contributions
-        return(top_server)
+        return(self._top_server)
+
+    def get_all_users(self):
+        with self._lock:
+            return(list(self.users.values()))
+
+    def get_all_servers(self):
+        with self._lock:
+            return(list(self.servers.values()))
 
     def get_available_models(self):
         models_ret = {}
-        for server in self.servers.values():
+        for server in self.get_all_servers():
             if server.is_stale():
                 continue
             models_ret[server.model] = models_ret.get(server.model,0) + 1
@@ -565,40 +729,52 @@ class Database:
 
     def count_active_servers(self):
         count = 0
-        for server in self.servers.values():
+        for server in self.get_all_servers():
             if not server.is_stale():
                 count += 1
         return(count)
 
+    def record_total_usage(self, chars):
+        # Every server's request thread updates these, so we need the lock to avoid losing updates
+        with self._lock:
+            self._totals["chars"] += chars
+            self._totals["fulfilments"] += 1
+
     def get_total_usage(self):
-        totals = {
-            "chars": 0,
-            "fulfilments": 0,
-        }
-        for server in self.servers.values():
-            totals["chars"] += server.contributions
-            totals["fulfilments"] += server.fulfilments
-        return(totals)
+        with self._lock:
+            return(dict(self._totals))
 
     def record_fulfilment(self, token_per_sec):
-        if len(self.stats["fulfilment_times"]) >= 10:
-            del self.stats["fulfilment_times"][0]
-        self.stats["fulfilment_times"].append(token_per_sec)
+        # Every server's request thread records here, so the eviction and running sum need to happen together
+        with self._lock:
+            if len(self.stats["fulfilment_times"]) == self.stats["fulfilment_times"].maxlen:
+                self._fulfilment_sum -= self.stats["fulfilment_times"][0]
+            self.stats["fulfilment_times"].append(token_per_sec)
+            self._fulfilment_sum += token_per_sec
+        self._dirty_stats = True
 
     def get_request_avg(self):
-        if len(self.stats["fulfilment_times"]) == 0:
-            return(0)
-        avg = sum(self.stats["fulfilment_times"]) / len(self.stats["fulfilment_times"])
+        with self._lock:
+            if len(self.stats["fulfilment_times"]) == 0:
+                return(0)
+            avg = self._fulfilment_sum / len(self.stats["fulfilment_times"])
         return(round(avg,1))
 
     def register_new_user(self, user):
-        self.last_user_id += 1
-        self.users[user.oauth_id] = user
-        logger.info(f'New user created: {user.username}#{self.last_user_id}')
-        return(self.last_user_id)
+        with self._lock:
+            self.last_user_id += 1
+            user_id = self.last_user_id
+            self.users[user.oauth_id] = user
+        self._dirty_users = True
+        logger.info(f'New user created: {user.username}#{user_id}')
+        return(user_id)
 
     def register_new_server(self, server):
-        self.servers[server.name] = server
+        with self._lock:
+            self.servers[server.name] = server
+            if server.user != self.anon:
+                self._persistent_servers[server] = None
+        self._dirty_servers = True
         logger.info(f'New server checked-in: {server.name} by {server.user.get_unique_alias()}')
 
     def find_user_by_oauth_id(self,oauth_id):
@@ -606,28 +782,41 @@ class Database:
             return(None)
         return(self.users.get(oauth_id))
 
+    def _index_user(self, user):
+        with self._lock:
+            self._users_by_api_key[user.api_key] = user
+            self._users_by_username_id[(user.username, user.id)] = user
+
+    def _unindex_user(self, user):
+        with self._lock:
+            if self._users_by_api_key.get(user.api_key) == user:
+                del self._users_by_api_key[user.api_key]
+            if self._users_by_username_id.get((user.username, user.id)) == user:
+                del self._users_by_username_id[(user.username, user.id)]
+
     def find_user_by_username(self, username):
-        for user in self.users.values():
-            uniq_username = username.split('#')
-            if user.username == uniq_username[0] and user.id == int(uniq_username[1]):
-                if user == self.anon and not self.ALLOW_ANONYMOUS:
-                    return(None)
-                return(user)
-        return(None)
+        # Usernames can themselves contain '#', so we only split on the last one, which precedes the id
+        uniq_username = username.rsplit('#',1)
+        # isdecimal() only accepts the characters int() can parse, unlike isdigit()
+        if len(uniq_username) != 2 or not uniq_username[1].isdecimal():
+            return(None)
+        user = self._users_by_username_id.get((uniq_username[0], int(uniq_username[1])))
+        if user == self.anon and not self.ALLOW_ANONYMOUS:
+            return(None)
+        return(user)
 
     def find_user_by_api_key(self,api_key):
-        for user in self.users.values():
-            if user.api_key == api_key:
-                if user == self.anon and not self.ALLOW_ANONYMOUS:
-                    return(None)
-                return(user)
-        return(None)
+        user = self._users_by_api_key.get(api_key)
+        if user == self.anon and not self.ALLOW_ANONYMOUS:
+            return(None)
+        return(user)
 
     def find_server_by_name(self,server_name):
         return(self.servers.get(server_name))
 
     def transfer_kudos(self, source_user, dest_user, amount):
-        if amount > source_user.kudos:
+        # We compare against the displayed kudos, so that float drift doesn't block transferring the full amount
+        if amount > round(source_user.kudos, 2):
             return([0,'Not enough kudos.'])
         source_user.modify_kudos(-amount, 'gifted')
         dest_user.modify_kudos(amount, 'received')
@@ -655,26 +844,53 @@ class Database:
 
     def calculate_model_multiplier(self, model_name):
         # To avoid doing this calculations all the time
-        multiplier = self.stats["model_mulitpliers"].get(model_name)
-        if multiplier:
-            return(multiplier)
+        if model_name in self.stats["model_mulitpliers"]:
+            return(self.stats["model_mulitpliers"][model_name])
+        # We don't want to block the request while we load the model config
+        # So we estimate a multiplier of 1 until the real one has been calculated
+        with self._lock:
+            failed_at = self._multiplier_failures.get(model_name)
+            can_retry = failed_at is None or self._now_tick - failed_at > self.multiplier_retry_interval
+            if model_name not in self._pending_multipliers and can_retry:
+                self._pending_multipliers.add(model_name)
+                self._multiplier_executor.submit(self.load_model_multiplier, model_name)
+        return(1)
+
+    def get_kudos_factor(self, model_name):
+        kudos_factor = self._kudos_factor.get(model_name)
+        if kudos_factor is None:
+            # The multiplier is still being calculated, so we use the estimate for now
+            kudos_factor = self.calculate_model_multiplier(model_name) / 100
+        return(kudos_factor)
+
+    def load_model_multiplier(self, model_name):
         try:
+            # These are slow to import and only needed here, so we only import them once a multiplier is missing
             import transformers, accelerate
-            config = transformers.AutoConfig.from_pretrained(model_name)
-            with accelerate.init_empty_weights():
-                model = transformers.AutoModelForCausalLM.from_config(config)
-            params_sum = sum(v.numel() for v in model.state_dict().values())
-            logger.info(params_sum)
-            multiplier = params_sum / 1000000000
-        except OSError:
-            logger.error(f"Model '{model_name}' not found in hugging face. Defaulting to multiplier of 1.")
-            multiplier = 1
-        self.stats["model_mulitpliers"][model_name] = multiplier
-        return(multiplier)
-
-    def convert_chars_to_kudos(self, chars, model_name):
-        multiplier = self.calculate_model_multiplier(model_name)
-        kudos = round(chars * multiplier / 100,2)
-        # logger.info([chars,multiplier,kudos])
-        return(kudos)
-
+        except ImportError:
+            logger.error(f"transformers is not installed. Using a multiplier of 1 for model '{model_name}' until it can be calculated.")
+            multiplier = None
+        else:
+            try:
+                config = transformers.AutoConfig.from_pretrained(model_name)
+                with accelerate.init_empty_weights():
+                    model = transformers.AutoModelForCausalLM.from_config(config)
+                params_sum = sum(v.numel() for v in model.state_dict().values())
+                logger.info(params_sum)
+                multiplier = params_sum / 1000000000
+            except OSError:
+                logger.error(f"Model '{model_name}' not found in hugging face. Defaulting to multiplier of 1.")
+                multiplier = 1
+            # Unexpected failures might be transient, so we don't store the fallback for them
+            except Exception:
+                logger.exception(f"Failed to calculate multiplier for model '{model_name}'. Using a multiplier of 1 until it can be calculated.")
+                multiplier = None
+        with self._lock:
+            self._pending_multipliers.discard(model_name)
+            if multiplier is None:
+                self._multiplier_failures[model_name] = self._now_tick
+                return
+            self._multiplier_failures.pop(model_name, None)
+            self.stats["model_mulitpliers"][model_name] = multiplier
+            self._kudos_factor[model_name] = multiplier / 100
+        self._dirty_stats = True